@@ -1,6 +1,5 @@
 import sys, os
 import argparse
-import glob
 import numpy as np
 from scipy.interpolate import interp1d
 import pandas as pd
@@ -72,6 +71,9 @@ def compute_GM_WM_distribution(subject, output_dir, spinal_levels_list, spinal_l
     spinal_levels_sup_img = Image(spinal_levels_sup_path)
     spinal_levels_inf_img = Image(spinal_levels_inf_path)
 
+    # Dictionaries to store the CSA DataFrames and temporary CSV files for each label (SC, GM, WM)
+    csa_dfs = {label: [] for label in seg_paths}
+    temp_csv_files = {label: [] for label in seg_paths}
 
     # Loop through each spinal level
     for level in spinal_levels_list:
@@ -128,10 +130,11 @@ def compute_GM_WM_distribution(subject, output_dir, spinal_levels_list, spinal_l
                 '-o', temp_csv,
             ])
 
-            # Add a column with the spinal level to the output CSV
+            # Add a column with the spinal level, and keep the DataFrame in memory for the final concatenation
             df = pd.read_csv(temp_csv)
             df['Spinal_Level'] = level
-            df.to_csv(temp_csv, index=False)
+            csa_dfs[label].append(df)
+            temp_csv_files[label].append(temp_csv)
 
     # Commpute sct_process_segmentation for all spinal levels combined
 
@@ -158,21 +161,19 @@ def compute_GM_WM_distribution(subject, output_dir, spinal_levels_list, spinal_l
             '-o', temp_csv,
         ])
 
-        # Add a column with the spinal level to the output CSV
+        # Add a column with the spinal level, and keep the DataFrame in memory for the final concatenation
         df = pd.read_csv(temp_csv)
         df['Spinal_Level'] = 'all_levels'
-        df.to_csv(temp_csv, index=False)
+        csa_dfs[label].append(df)
+        temp_csv_files[label].append(temp_csv)
 
-    # At the end, concatenate all CSV files for each label into a single CSV file for each subject
+    # At the end, concatenate all CSA results for each label into a single CSV file for each subject
+    # (the DataFrames are already in memory, so the temporary CSV files do not need to be written and read again)
     for label in ['SC', 'GM', 'WM']:
         print(f"---- Concatenating {label} CSA CSV files for {subject} ----")
 
-        # Get all temporary CSV files for the subject and label
-        temp_csv_files = glob.glob(os.path.join(output_dir, label, f'{subject}_{label}_*_CSA.csv'))
-
-        # Concatenate all CSV files into a single DataFrame
-        df_list = [pd.read_csv(f) for f in temp_csv_files]
-        df_concat = pd.concat(df_list, ignore_index=True)
+        # Concatenate all CSA results into a single DataFrame
+        df_concat = pd.concat(csa_dfs[label], ignore_index=True)
 
         # Define final output CSV file path
         final_csv = os.path.join(output_dir, label, f'{subject}_{label}_CSA.csv')
@@ -183,7 +184,7 @@ def compute_GM_WM_distribution(subject, output_dir, spinal_levels_list, spinal_l
         print(f"Saved concatenated CSV for {label} at {final_csv}")
 
         # Remove the temporary CSV files
-        for f in temp_csv_files:
+        for f in temp_csv_files[label]:
             os.remove(f)
     
 def main(subject, data_path, path_output, subject_dir, file_t2star):
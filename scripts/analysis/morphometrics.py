@@ -1,9 +1,13 @@
 import sys, os
+import re
 import argparse
 import glob
+import functools
+import traceback
 import numpy as np
 from scipy.interpolate import interp1d
 import pandas as pd
+from joblib import Parallel, delayed
 import spinalcordtoolbox.utils as sct
 from spinalcordtoolbox.scripts import sct_process_segmentation
 
@@ -23,9 +27,31 @@ Usage :
         
         sct_run_batch -config config/config_morphometrics.yaml -script wrappers/wrapper_morphometrics.sh
 
+    Alternatively, a list of subjects can be processed in parallel (one worker process per subject) using the `--cohort` flag :
+
+        python scripts/analysis/morphometrics.py --data-path <path_data> --path-output <path_output> --cohort sub-001 sub-002 ...
+
 Author: Samuelle St-Onge
 """
 
+# Regex to get the subject ID from the `Filename` column of the `sct_process_segmentation` output
+SUBJECT_ID_REGEX = re.compile(r'sub-([0-9]+)')
+
+@functools.lru_cache(maxsize=4)
+def _load_participants(participants_info):
+    """
+    Load the `participants.tsv` file once and keep only the subject, age and sex columns.
+    The result is cached, so the file is only parsed once per path.
+
+    Args :
+        participants_info: Path to the `participants.tsv` file
+    """
+    df_participants = pd.read_csv(participants_info, sep='\t')
+    df_participants.columns = df_participants.columns.str.strip()
+    df_participants = df_participants.rename(columns={'participant_id': 'subject'})
+    return df_participants[['subject', 'age', 'sex']]
+
+
 def compute_morphometrics(level_type, output_csv_filename, participants_info, t2w_seg_file, label_file, levels, perlevel=0, perslice=0, pmj=None):
     """
     This function computes spinal cord morphometrics using `sct_process_segmentation`. 
@@ -42,30 +68,35 @@ def compute_morphometrics(level_type, output_csv_filename, participants_info, t2
         perslice: Output either one metric per slice (perslice=1) or a single output metric for all slices (perslice=0)
         pmj: Path to the PMJ label
     """
-    # Run sct_process_segmentation
-    sct_process_segmentation.main([
-        '-i', t2w_seg_file,
-        '-vert', levels,
-        '-vertfile', label_file,
-        '-perlevel', perlevel,
-        '-perslice', perslice,
-        '-pmj', pmj,
-        '-o', output_csv_filename
-    ])
+    # Run sct_process_segmentation, unless the output CSV file is already more recent than the input files
+    input_files = [f for f in [t2w_seg_file, label_file, pmj] if f is not None]
+    if os.path.exists(output_csv_filename) and os.path.getmtime(output_csv_filename) > max(os.path.getmtime(f) for f in input_files):
+        print(f"Morphometrics CSV file is up to date: {output_csv_filename}. Skipping sct_process_segmentation.")
+    else:
+        sct_process_segmentation.main([
+            '-i', t2w_seg_file,
+            '-vert', levels,
+            '-vertfile', label_file,
+            '-perlevel', perlevel,
+            '-perslice', perslice,
+            '-pmj', pmj,
+            '-o', output_csv_filename
+        ])
 
     # Load results in output CSV file 
     df = pd.read_csv(output_csv_filename)
 
     # Get the subject ID from the filename
-    df['subject'] = 'sub-' + df['Filename'].astype(str).str.extract(r'sub-([0-9]+)')[0]
+    # (the regex is applied once per unique filename, using a categorical column)
+    filenames = df['Filename'].astype(str).astype('category')
+    df['subject'] = 'sub-' + filenames.str.extract(SUBJECT_ID_REGEX, expand=False)
 
     # Get the age and sex from the `participants.tsv`` file, and add to the morphometrics CSV file 
-    df_age = pd.read_csv(participants_info, sep='\t').rename(columns={'participant_id': 'subject'})
+    df_age = _load_participants(participants_info)
     df.columns = df.columns.str.strip()
-    df_age.columns = df_age.columns.str.strip()
 
     df = df.drop(columns=[col for col in ['age', 'sex'] if col in df.columns])
-    df_merged = df.merge(df_age[['subject', 'age', 'sex']], on='subject', how='left')
+    df_merged = df.merge(df_age, on='subject', how='left')
 
     # Rename columns and save the changes to the CSV file
     df_merged = df_merged.rename(columns={
@@ -149,8 +180,8 @@ def compute_interpolated_morphometrics(data_path, output_csv_path, output_csv_fi
     csv_file_interpolated = pd.read_csv(output_interp_csv)
 
     # Merge age and sex into the interpolated CSV before processing
-    df_participants_info = pd.read_csv(participants_info, sep='\t').rename(columns={'participant_id': 'subject'})
-    csv_file_interpolated = csv_file_interpolated.merge(df_participants_info[['subject', 'age', 'sex']], on='subject', how='left')
+    df_participants_info = _load_participants(participants_info)
+    csv_file_interpolated = csv_file_interpolated.merge(df_participants_info, on='subject', how='left')
 
     # Iterate through each row in the interpolated CSV file and compute morphometrics for each PMJ distance (each VertLevel interval)
     for index, row in csv_file_interpolated.iterrows():
@@ -192,14 +223,14 @@ def compute_interpolated_morphometrics(data_path, output_csv_path, output_csv_fi
         temp_df['subject'] = subject
 
         # Append to the results list (this list will then contain all morphometrics for each PMJ distance, i.e. from each temp CSV file)
-        all_results.append(temp_df[['subject', 'VertLevel', 'DistancePMJ', 'CSA', 'AP_diameter', 'RL_diameter', 'eccentricity', 'solidity']])
-        print(f"Processed VertLevel {level} (PMJ distance : {distance_pmj})")
+        all_results.append(temp_df[['subject', level_type, 'DistancePMJ', 'CSA', 'AP_diameter', 'RL_diameter', 'eccentricity', 'solidity']])
+        print(f"Processed {level_type} {level} (PMJ distance : {distance_pmj})")
 
     # Save all results to a final CSV file
     final_results_df = pd.concat(all_results, ignore_index=True)
     
     # Add age and sex columns to the final CSV file
-    final_results_df = final_results_df.merge(df_participants_info[['subject', 'age', 'sex']], on='subject', how='left')
+    final_results_df = final_results_df.merge(df_participants_info, on='subject', how='left')
     
     # Save the final results to a CSV file
     final_results_df.to_csv(final_csv_filename, index=False)
@@ -240,68 +271,115 @@ def main(subject, data_path, path_output, subject_dir, file_t2):
     else:
         print(f"Processing subject: {subject}")
 
-    ########## FOR VERTEBRAL LEVELS ##########
-
-    # 1. Compute morphometrics per slice and per level
-    compute_morphometrics(
-        level_type = 'VertLevel',
-        output_csv_filename=os.path.join(output_csv_dir, f"{subject}_vert_level_morphometrics.csv"),
-        participants_info=participants_info,
-        t2w_seg_file=t2w_seg_file,
-        label_file=t2w_labeled_seg, # Use the labeled segmentation 
-        levels='1:20',
-        perlevel='1',
-        perslice='1',
-        pmj=t2w_pmj_label
-    )
-
-    # 2. Interpolate PMJ distances for each Vertebral Level 
-    compute_interpolated_morphometrics(data_path, 
-                                       path_output,
-                                       output_csv_filename=os.path.join(output_csv_dir, f"{subject}_vert_level_morphometrics.csv"), 
-                                       level_type='VertLevel', 
-                                       t2w_pmj_label=t2w_pmj_label, 
-                                       t2w_seg_file=t2w_seg_file, 
-                                       participants_info=participants_info, 
-                                       final_csv_filename=final_csv_filename_vertlevels, 
-                                       subject=subject)
-
-    ########## FOR SPINAL LEVELS ##########
-
     # Note : the spinal levels are extracted from the rootlets segmentation, in the rootlets.py script. This script has to be run previously to generate the spinal levels. 
 
-    # 1. Compute morphometrics per slice and per level
-    compute_morphometrics(
-        level_type='SpinalLevel',
-        output_csv_filename=os.path.join(output_csv_dir, f"{subject}_spinal_level_morphometrics.csv"),
-        participants_info=participants_info,
-        t2w_seg_file=t2w_seg_file,
-        label_file=spinal_levels, # Use spinal levels 
-        levels='1:8',
-        perlevel='1',
-        perslice='1',
-        pmj=t2w_pmj_label
-    )
-
-    # 2. Interpolate PMJ distances for each Vertebral Level 
-    compute_interpolated_morphometrics(data_path, 
-                                       path_output,
-                                       output_csv_filename=os.path.join(output_csv_dir, f"{subject}_spinallevel_morphometrics.csv"), 
-                                       level_type='SpinalLevel', 
-                                       t2w_pmj_label=t2w_pmj_label, 
-                                       t2w_seg_file=t2w_seg_file, 
-                                       participants_info=participants_info, 
-                                       final_csv_filename=final_csv_filename_spinallevels, 
-                                       subject=subject)
+    # Level types to process : (level type, CSV suffix, label file, levels, final CSV file)
+    level_configs = [
+        ('VertLevel', 'vert_level', t2w_labeled_seg, '1:20', final_csv_filename_vertlevels),  # Use the labeled segmentation
+        ('SpinalLevel', 'spinal_level', spinal_levels, '1:8', final_csv_filename_spinallevels),  # Use spinal levels
+    ]
+
+    for level_type, csv_suffix, label_file, levels, final_csv_filename in level_configs:
+
+        # Use the same per-level CSV file for both the morphometrics computation and the interpolation
+        level_csv_filename = os.path.join(output_csv_dir, f"{subject}_{csv_suffix}_morphometrics.csv")
+
+        # 1. Compute morphometrics per slice and per level
+        compute_morphometrics(
+            level_type=level_type,
+            output_csv_filename=level_csv_filename,
+            participants_info=participants_info,
+            t2w_seg_file=t2w_seg_file,
+            label_file=label_file,
+            levels=levels,
+            perlevel='1',
+            perslice='1',
+            pmj=t2w_pmj_label
+        )
+
+        # 2. Interpolate PMJ distances for each level
+        compute_interpolated_morphometrics(data_path, 
+                                           path_output,
+                                           output_csv_filename=level_csv_filename, 
+                                           level_type=level_type, 
+                                           t2w_pmj_label=t2w_pmj_label, 
+                                           t2w_seg_file=t2w_seg_file, 
+                                           participants_info=participants_info, 
+                                           final_csv_filename=final_csv_filename, 
+                                           subject=subject)
+
+def _run_subject(subject, *args):
+    """
+    This function runs `main` for one subject of a cohort, and catches any error so that the other subjects are still processed
+    (as with `sct_run_batch`, where each subject is run separately).
+
+    Returns :
+        True if the subject was processed successfully, False otherwise
+    """
+    try:
+        main(subject, *args)
+    except (Exception, SystemExit):
+        print(f"ERROR : processing failed for subject {subject}")
+        traceback.print_exc()
+        return False
+    return True
+
+
+def run_cohort(subjects, data_path, path_output, n_jobs=-1):
+    """
+    This function runs `main` for a list of subjects in parallel, with one worker process per subject.
+    A subject that fails does not stop the other subjects; the failed subjects are reported at the end.
+    The subject folder and T2w file prefix are defined in the same way as in the `wrapper_morphometrics.sh` wrapper.
+
+    Args :
+        subjects: List of subject IDs (e.g., ['sub-001', 'sub-002'])
+        data_path: Path to raw data
+        path_output: Path to output results
+        n_jobs: Number of parallel jobs (-1 uses all CPU cores)
+    """
+    jobs = []
+    job_subjects = []
+    for subject in subjects:
+        subject_dir = os.path.join(data_path, "derivatives", "labels", subject, "anat")
+
+        # Use the composed T2w file if it exists, otherwise use the top acquisition T2w file
+        file_t2_composed = f"{subject}_rec-composed_T2w"
+        file_t2_top = f"{subject}_acq-top_run-1_T2w"
+        if os.path.isfile(os.path.join(data_path, subject, "anat", f"{file_t2_composed}.nii.gz")):
+            file_t2 = file_t2_composed
+        elif os.path.isfile(os.path.join(data_path, subject, "anat", f"{file_t2_top}.nii.gz")):
+            file_t2 = file_t2_top
+            print(f"Composed T2w file not found for subject {subject}. Proceeding with top T2w file.")
+        else:
+            print(f"Neither composed nor top T2w file found for subject {subject}. Skipping.")
+            continue
+
+        jobs.append(delayed(_run_subject)(subject, data_path, path_output, subject_dir, file_t2))
+        job_subjects.append(subject)
+
+    success = Parallel(n_jobs=n_jobs, backend='loky')(jobs)
+
+    # Report the subjects that failed
+    failed_subjects = [subject for subject, ok in zip(job_subjects, success) if not ok]
+    if failed_subjects:
+        print(f"Processing failed for {len(failed_subjects)} subject(s) : {', '.join(failed_subjects)}")
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run morphometric extraction for one subject")
-    parser.add_argument("--subject", required=True, help="Subject ID (e.g., sub-001)")
+    parser = argparse.ArgumentParser(description="Run morphometric extraction for one subject, or for a cohort of subjects in parallel")
+    parser.add_argument("--subject", help="Subject ID (e.g., sub-001)")
     parser.add_argument("--data-path", required=True, help="Path to raw data")
     parser.add_argument("--path-output", required=True, help="Path to output results")
-    parser.add_argument("--subject-dir", required=True, help="Path to subject folder (e.g., sub-001)")
-    parser.add_argument("--file-t2", required=True, help="T2-weighted image prefix (e.g., sub-01_T2w)")
+    parser.add_argument("--subject-dir", help="Path to subject folder (e.g., sub-001)")
+    parser.add_argument("--file-t2", help="T2-weighted image prefix (e.g., sub-01_T2w)")
+    parser.add_argument("--cohort", nargs='+', help="List of subject IDs to process in parallel (e.g., sub-001 sub-002). Replaces --subject, --subject-dir and --file-t2")
+    parser.add_argument("--jobs", type=int, default=-1, help="Number of parallel jobs used with --cohort (-1 uses all CPU cores)")
 
     args = parser.parse_args()
 
-    main(args.subject, args.data_path, args.path_output, args.subject_dir, args.file_t2)
+    if args.cohort:
+        run_cohort(args.cohort, args.data_path, args.path_output, n_jobs=args.jobs)
+    else:
+        if not (args.subject and args.subject_dir and args.file_t2):
+            parser.error("--subject, --subject-dir and --file-t2 are required when --cohort is not used")
+        main(args.subject, args.data_path, args.path_output, args.subject_dir, args.file_t2)
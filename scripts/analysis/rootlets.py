@@ -4,9 +4,14 @@ import argparse
 import numpy as np
 import os
 import shutil
+import functools
+import traceback
 import pandas as pd
+from scipy.spatial import cKDTree
+from joblib import Parallel, delayed
 from spinalcordtoolbox.scripts import sct_label_utils
 from spinalcordtoolbox.image import Image
+import spinalcordtoolbox.labels as sct_labels
 
 """
 This script is used to extract spinal levels from the segmented rootlets of the spinal cord in pediatric subjects. The script calls functions from
@@ -15,7 +20,7 @@ the https://github.com/ivadomed/model-spinal-rootlets repository to process the
 The script : 
     - Runs `zeroing_false_positive_rootlets.py` from the model-spinal-rootlets/pediatric_rootlets directory to remove false positive rootlets below the Th1 level.
     - Runs `02a_rootlets_to_spinal_levels.py` from the model-spinal-rootlets/inter-rater_variability directory to extract spinal levels from the rootlets segmentation.
-    - Extracts the center of mass of each spinal level and saves it in a nii.gz file.
+    - Extracts the center of mass of each spinal level and saves it in a nii file.
     - Computes the distance between the center of mass of each spinal level and the PMJ, and saves it to a CSV file. 
     - Computes the distance between the vertebral levels and the PMJ, and saves it to a CSV file. 
 
@@ -23,11 +28,30 @@ Usage :
     The script can be ran with sct_run_batch using the wrapper script `wrapper_rootlets.sh` as follows:
         
         sct_run_batch -config config/config_rootlets.yaml -script wrappers/wrapper_rootlets.sh
+
+    Alternatively, a list of subjects can be processed in parallel (one worker process per subject) using the `--cohort` flag :
+
+        python scripts/analysis/rootlets.py --data-path <path_data> --rootlets-model-dir <path_to_model> --cohort sub-001 sub-002 ...
     
 Author: Samuelle St-Onge
 
 """
 
+@functools.lru_cache(maxsize=1)
+def _load_image(path, mtime):
+    """
+    Function to load a NIfTI image, cached on the path and modification time of the file.
+    Only the last image is kept, since the centerline is the only image reused for a subject (and worker processes are reused across subjects with --cohort).
+    """
+    return Image(path)
+
+def load_image(path):
+    """
+    Function to load a NIfTI image that is used several times for the same subject (e.g., the centerline).
+    The image is only decompressed and loaded once (as long as the file is not modified), and a copy is returned so the cached image is never modified.
+    """
+    return _load_image(path, os.path.getmtime(path)).copy()
+
 def get_distance_from_pmj(centerline_points, z_index, px, py, pz):
     """
     Function taken from : model-rootlets-r20250318/inter-rater_variability/02a_rootlets_to_spinal_levels.py 
@@ -43,82 +67,89 @@ def get_distance_from_pmj(centerline_points, z_index, px, py, pz):
     :param pz: z pixel size.
     :return: nd-array: distance from PMJ and corresponding indexes.
     """
-    length = 0
-    arr_length = [0]
-    for i in range(z_index, 0, -1):
-        distance = np.sqrt(((centerline_points[0, i] - centerline_points[0, i - 1]) * px) ** 2 +
-                           ((centerline_points[1, i] - centerline_points[1, i - 1]) * py) ** 2 +
-                           ((centerline_points[2, i] - centerline_points[2, i - 1]) * pz) ** 2)
-        length += distance
-        arr_length.append(length)
-    arr_length = arr_length[::-1]
+    # Length of each centerline segment (in mm) between the first slice and the PMJ
+    diffs = np.diff(centerline_points[:, :z_index + 1], axis=1) * np.array([[px], [py], [pz]])
+    seg = np.linalg.norm(diffs, axis=0)
+    # Cumulative distance from the PMJ (z_index) down to each slice
+    arr_length = np.concatenate((np.cumsum(seg[::-1])[::-1], [0.0]))
     arr_length = np.stack((arr_length, centerline_points[2][:z_index + 1]), axis=0)
 
     return arr_length
 
-def find_nearest_centerline_index(point, centerline_points):
-    distances = np.linalg.norm(centerline_points.T - point, axis=1)
-    return np.argmin(distances)
-
-def center_of_mass_to_PMJ(label, label_fname, file_t2, subject_dir, pmj_label, centerline_csv, participants_tsv, csv_out_path):
+def prepare_centerline_context(centerline_csv, dims):
     """
-    Function to compute the distance from the center of mass of each spinal level or vert level to the PMJ.
-    
-    This function : 
-    - Computes the center of mass from the labels using sct_label_utils
-    - Projects the labels to the spinal cord centerline using sct_label_utils
-    - Computes the distance from the center of mass to the PMJ using the centerline coordinates and the PMJ label.
+    Function to load the centerline and compute the distance from the PMJ along the centerline.
+    The returned distances and KD-tree can be shared across several calls of `center_of_mass_to_PMJ` for the same subject.
 
+    :param centerline_csv: Path to the centerline CSV file (3xn array in RPI orientation).
+    :param dims: Voxel sizes (px, py, pz).
+    :return: tuple (centerline_dist, tree), where `tree` is a KD-tree built on the centerline points.
     """
+    # Load centerline CSV (3xn array : one row for each x, y, z coordinate)
+    centerline_array = pd.read_csv(centerline_csv, header=None, dtype=np.float64, engine='c').to_numpy()
 
-    # Extract the center of mass of each spinal level and save it in a nii.gz file
-    sct_label_utils.main([
-        '-i', label_fname,
-        '-cubic-to-point',  # To compute center of mass
-        '-o', f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}.nii.gz',
-    ]) 
+    # Get the PMJ index on the centerline (which corresponds to the max z value)
+    pmj_index = centerline_array[2].argmax()
 
-    # Project the center of mass of the spinal levels onto the centerline to obtain the vertebral levels
-    sct_label_utils.main([
-        '-i', f'{subject_dir}/{file_t2}_centerline.nii.gz',
-        '-project-centerline', f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}.nii.gz',
-        '-o', f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}_projected.nii.gz'
-    ])
+    # Compute the cumulative distance from the PMJ along the centerline
+    px, py, pz = dims
+    centerline_dist = get_distance_from_pmj(centerline_array, pmj_index, px, py, pz)
 
-    # Load center of mass image (labels) and get the coordinates of the center of mass points (x, y, z, label)
-    center_of_mass_label_image = Image(f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}_projected.nii.gz').change_orientation('RPI')
-    center_of_mass_coords = center_of_mass_label_image.getNonZeroCoordinates(sorting='value')
+    # Build a KD-tree on the centerline points to find the nearest centerline point of each center of mass point
+    tree = cKDTree(centerline_array.T)
 
-    # Load centerline CSV 
-    centerline_array = np.genfromtxt(centerline_csv, delimiter=',')
+    return centerline_dist, tree
 
-    # Get the PMJ index on the centerline (which corresponds to the max z value)
-    pmj_index = centerline_array[2].argmax()
+def center_of_mass_to_PMJ(label, label_fname, file_t2, subject_dir, centerline_dist, tree, participants_tsv, csv_out_path):
+    """
+    Function to compute the distance from the center of mass of each spinal level or vert level to the PMJ.
+    
+    This function : 
+    - Computes the center of mass from the labels (same as `sct_label_utils -cubic-to-point`)
+    - Projects the labels to the spinal cord centerline (same as `sct_label_utils -project-centerline`)
+    - Computes the distance from the center of mass to the PMJ, using the distance from the PMJ of the nearest centerline point (found with the KD-tree `tree` and looked up in `centerline_dist`).
 
-    # Get voxel sizes from the PMJ label image for physical distances (assumed consistent across images)
-    pmj_img = Image(pmj_label).change_orientation('RPI')
-    px, py, pz = pmj_img.dim[4], pmj_img.dim[5], pmj_img.dim[6]
+    The centerline distances from the PMJ (`centerline_dist`) and the KD-tree on the centerline points (`tree`) are computed once per subject with `prepare_centerline_context`.
+    """
 
-    # Compute the cumulative distance from the PMJ along the centerline
-    centerline_dist = get_distance_from_pmj(centerline_array, pmj_index, px, py, pz)
+    # The center of mass images are intermediate files, so they are saved uncompressed (.nii) to avoid the cost of gzip compression
+    com_fname = f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}.nii'
+    projected_fname = f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}_projected.nii'
+
+    # Extract the center of mass of each spinal level and save it in a nii file
+    # (the `spinalcordtoolbox.labels` functions are called directly, which is what `sct_label_utils -cubic-to-point` does)
+    center_of_mass_image = sct_labels.cubic_to_point(Image(label_fname))
+    center_of_mass_image.save(com_fname)
+
+    # Project the center of mass of the spinal levels onto the centerline to obtain the vertebral levels
+    # (equivalent to `sct_label_utils -project-centerline`, reusing the center of mass image already in memory)
+    center_of_mass_label_image = sct_labels.project_centerline(load_image(f'{subject_dir}/{file_t2}_centerline.nii.gz'), center_of_mass_image)
+    center_of_mass_label_image.save(projected_fname)
+
+    # Get the coordinates of the center of mass points (x, y, z, label) in RPI orientation
+    center_of_mass_label_image.change_orientation('RPI')
+    center_of_mass_data = center_of_mass_label_image.data
+    center_of_mass_coords = np.argwhere(center_of_mass_data)
+    center_of_mass_values = center_of_mass_data[tuple(center_of_mass_coords.T)]
+    # Sort the center of mass points by label value
+    order = np.argsort(center_of_mass_values, kind='stable')
+    center_of_mass_coords = center_of_mass_coords[order]
+    center_of_mass_values = center_of_mass_values[order]
+
+    # Find the nearest centerline point of each center of mass point
+    _, idxs = tree.query(center_of_mass_coords, k=1)
 
     # Get the distance from PMJ for the nearest centerline point coresponding to the center of mass point
-    results = []
-    for x, y, z, label_index in center_of_mass_coords:
-        point = np.array([x, y, z])
-        nearest_centerline_index = find_nearest_centerline_index(point, centerline_array)
-        dist_to_pmj = centerline_dist[0, nearest_centerline_index] # Distance from PMJ to the center of mass point
-        results.append({
-            'level': int(label_index),
-            'fname': f'{subject_dir}/{file_t2}_label-rootlets_center_of_mass_{label}_projected.nii.gz',
-            'x': x,
-            'y': y,
-            'z': z,
-            'distance_from_pmj_mm': dist_to_pmj
-            })
+    df_com_dist = pd.DataFrame({
+        'level': center_of_mass_values.astype(int),
+        'fname': np.full(len(center_of_mass_coords), projected_fname),
+        'x': center_of_mass_coords[:, 0],
+        'y': center_of_mass_coords[:, 1],
+        'z': center_of_mass_coords[:, 2],
+        'distance_from_pmj_mm': centerline_dist[0, idxs]
+        })
 
     # Save results to CSV in the results folder alongside the PMJ distance CSV
-    df_com_dist = pd.DataFrame(results)
     df_com_dist.to_csv(csv_out_path, index=False)
     print(f"Center of mass distances saved to {csv_out_path}")
 
@@ -136,7 +167,7 @@ def create_single_voxel_point_labels(subject, data_path, subject_dir, t2w, t2w_c
     print(df)
     
     # Get the centerline image
-    centerline = Image(t2w_centerline) 
+    centerline = load_image(t2w_centerline)
 
     # path to save the label images with single voxel points for the start and end of each spinal level
     output_path_inf = os.path.join(data_path, f"derivatives/labels/{subject}/anat/{file_t2}_label-rootlets_spinal_levels_inf_dlabel.nii.gz")
@@ -198,7 +229,32 @@ def create_single_voxel_point_labels(subject, data_path, subject_dir, t2w, t2w_c
     print(f"Single voxel point labels for the end of each spinal level saved to {output_path_sup}")
 
 
-def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir):
+def generate_figures(participants_tsv):
+    """
+    Function to generate the figures comparing spinal levels and vertebral levels, from the PMJ distance CSV files of all processed subjects.
+    """
+
+    # Generate the figures for all subjects (male + female), female subjects only and male subjects only.
+    # The three figures are independent, so the scripts are run concurrently.
+    procs = [
+        subprocess.Popen([
+            sys.executable,
+            os.path.join(f'results/plots/', "generate_figure_rootlets_and_vertebral_spinal_levels.py"),
+            "-i", 'results/tables/rootlets', # path to pmj distance csv files
+            "-participants", participants_tsv,
+            *sex_args
+        ])
+        for sex_args in [[], ['-sex', 'F'], ['-sex', 'M']]
+    ]
+
+    # Wait for all figures to be generated, and raise an error if one of the scripts failed
+    returncodes = [proc.wait() for proc in procs]
+    for proc, returncode in zip(procs, returncodes):
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, proc.args)
+
+
+def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir, run_figures=True):
 
     # Define paths
     t2w = os.path.join(data_path, f"{subject}/anat/{file_t2}.nii.gz")
@@ -246,15 +302,15 @@ def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir):
         PMJ_rootlets_dist_src = f'{subject_dir}/{file_t2}_label-rootlets_dseg_modif_pmj_distance.csv'
         PMJ_vertlevels_dist_src = f'{subject_dir}/{file_t2}_labels-disc_step1_levels_pmj_distance_vertebral_disc.csv'
 
-        # Move the files
-        shutil.move(PMJ_rootlets_dist_src, dst_folder)
-        shutil.move(PMJ_vertlevels_dist_src, dst_folder)
-
-        # Rename the rootlets PMJ distance CSV file to add "_rootlets" to the filename
-        old_path = os.path.join(dst_folder, os.path.basename(PMJ_rootlets_dist_src))
+        # Move the files, adding "_rootlets" to the filename of the rootlets PMJ distance CSV file
         new_filename = os.path.basename(PMJ_rootlets_dist_src).replace('_pmj_distance.csv', '_pmj_distance_rootlets.csv')
-        new_path = os.path.join(dst_folder, new_filename)
-        os.rename(old_path, new_path)
+        shutil.move(PMJ_rootlets_dist_src, os.path.join(dst_folder, new_filename))
+        shutil.move(PMJ_vertlevels_dist_src, os.path.join(dst_folder, os.path.basename(PMJ_vertlevels_dist_src)))
+
+        # Load the centerline and compute the distance from the PMJ along the centerline (shared by the spinal levels and vertebral levels)
+        # Voxel sizes are taken from the centerline image in RPI orientation (assumed consistent across images)
+        dims = load_image(t2w_centerline).change_orientation('RPI').dim[4:7]
+        centerline_dist, tree = prepare_centerline_context(centerline_csv, dims)
 
         # Compute the distance from the center of mass of each spinal level to the PMJ
         spinal_levels_label_file = f'{subject_dir}/{file_t2}_label-rootlets_dseg_modif_spinal_levels.nii.gz'
@@ -263,8 +319,8 @@ def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir):
             label_fname=spinal_levels_label_file,
             file_t2=file_t2,
             subject_dir=subject_dir,
-            pmj_label=pmj_label,
-            centerline_csv=centerline_csv,
+            centerline_dist=centerline_dist,
+            tree=tree,
             participants_tsv=participants_tsv,
             csv_out_path=os.path.join(dst_folder, f"{file_t2}_label-rootlets_center_of_mass_spinal_levels_pmj_distance.csv")
         )
@@ -276,8 +332,8 @@ def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir):
             label_fname=vert_levels_label_file,
             file_t2=file_t2,
             subject_dir=subject_dir,
-            pmj_label=pmj_label,
-            centerline_csv=centerline_csv,
+            centerline_dist=centerline_dist,
+            tree=tree,
             participants_tsv=participants_tsv,
             csv_out_path=os.path.join(dst_folder, f"{file_t2}_label-rootlets_center_of_mass_vert_levels_pmj_distance.csv")
         )
@@ -285,43 +341,71 @@ def main(subject, data_path, subject_dir, file_t2, rootlets_model_dir):
     else:
         print(f"Rootlets already processed for subject {subject}. Going straight to generating figure.")
     
-    # Generate figure for all subjects (male + female)
-    subprocess.run([
-        python_executable,
-        os.path.join(f'results/plots/', "generate_figure_rootlets_and_vertebral_spinal_levels.py"),
-        "-i", 'results/tables/rootlets', # path to pmj distance csv files
-        "-participants", participants_tsv
-    ], check=True)
-
-    # Generate figure for female subjects only
-    subprocess.run([
-        python_executable,
-        os.path.join(f'results/plots/', "generate_figure_rootlets_and_vertebral_spinal_levels.py"),
-        "-i", 'results/tables/rootlets', # path to pmj distance csv files
-        "-participants", participants_tsv,
-        '-sex', 'F'
-    ], check=True)
-
-    # Generate figure for male subjects only 
-    subprocess.run([
-        python_executable,
-        os.path.join(f'results/plots/', "generate_figure_rootlets_and_vertebral_spinal_levels.py"),
-        "-i", 'results/tables/rootlets', # path to pmj distance csv files
-        "-participants", participants_tsv,
-        '-sex', 'M'
-    ], check=True)
+    # Generate figures for all subjects, female subjects and male subjects
+    if run_figures:
+        generate_figures(participants_tsv)
 
     # Create a label file containing single voxel points at the start and end of each spinal level
     create_single_voxel_point_labels(subject, data_path, subject_dir, t2w, t2w_centerline, file_t2, rootlets_csv_folder='results/tables/rootlets')
 
+def _run_subject(subject, *args, **kwargs):
+    """
+    Function to run `main` for one subject of a cohort, catching any error so that the other subjects are still processed
+    (as with `sct_run_batch`, where each subject is run separately).
+    Returns True if the subject was processed successfully, False otherwise.
+    """
+    try:
+        main(subject, *args, **kwargs)
+    except (Exception, SystemExit):
+        print(f"ERROR : processing failed for subject {subject}")
+        traceback.print_exc()
+        return False
+    return True
+
+def run_cohort(subjects, data_path, rootlets_model_dir, n_jobs=-1):
+    """
+    Function to run `main` for a list of subjects in parallel, with one worker process per subject.
+    A subject that fails does not stop the other subjects; the failed subjects are reported at the end.
+    The figures are generated once, after all subjects are processed, from the subjects that succeeded.
+    """
+    success = Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_run_subject)(
+            subject,
+            data_path,
+            os.path.join(data_path, "derivatives", "labels", subject, "anat"),
+            f"{subject}_acq-top_run-1_T2w",
+            rootlets_model_dir,
+            run_figures=False
+        )
+        for subject in subjects
+    )
+
+    # Report the subjects that failed
+    failed_subjects = [subject for subject, ok in zip(subjects, success) if not ok]
+    if failed_subjects:
+        print(f"Processing failed for {len(failed_subjects)} subject(s) : {', '.join(failed_subjects)}")
+
+    # Generate the figures from the subjects that were processed successfully
+    if any(success):
+        generate_figures(os.path.join(data_path, 'participants.tsv'))
+    else:
+        print("No subject was processed successfully. Skipping figure generation.")
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run rootlets processing for one subject")
-    parser.add_argument("--subject", required=True, help="Subject ID (e.g., sub-001)")
+    parser = argparse.ArgumentParser(description="Run rootlets processing for one subject, or for a cohort of subjects in parallel")
+    parser.add_argument("--subject", help="Subject ID (e.g., sub-001)")
     parser.add_argument("--data-path", required=True, help="Path to raw data")
-    parser.add_argument("--subject-dir", required=True, help="Path to subject folder")
-    parser.add_argument("--file-t2", required=True, help="T2-weighted filename prefix")
+    parser.add_argument("--subject-dir", help="Path to subject folder")
+    parser.add_argument("--file-t2", help="T2-weighted filename prefix")
     parser.add_argument("--rootlets-model-dir", required=True, help="Path to your local `model-spinal-rootlets` repository")
+    parser.add_argument("--cohort", nargs='+', help="List of subject IDs to process in parallel (e.g., sub-001 sub-002). Replaces --subject, --subject-dir and --file-t2")
+    parser.add_argument("--jobs", type=int, default=-1, help="Number of parallel jobs used with --cohort (-1 uses all CPU cores)")
     args = parser.parse_args()
 
-    main(args.subject, args.data_path, args.subject_dir, args.file_t2, args.rootlets_model_dir)
-
+    if args.cohort:
+        run_cohort(args.cohort, args.data_path, args.rootlets_model_dir, n_jobs=args.jobs)
+    else:
+        if not (args.subject and args.subject_dir and args.file_t2):
+            parser.error("--subject, --subject-dir and --file-t2 are required when --cohort is not used")
+        main(args.subject, args.data_path, args.subject_dir, args.file_t2, args.rootlets_model_dir)